@@ -1,40 +1,73 @@
 """GUI functionality for the browser."""
 
+import array
+import bisect
+import collections
+import queue
+import re
+import sys
+import threading
 import tkinter
 import tkinter.font
 from url import URL
 
 WIDTH, HEIGHT = 800, 600
 SCROLL_STEP = 100
+LOAD_POLL_MS = 10  # How often to check whether a page has finished loading.
 HSTEP, VSTEP = 13, 18
+WORD_WIDTH_CACHE_SIZE = 1 << 16  # Max words remembered per font in FONT_CACHE.
 
 # Store tkinter font objects in a dictionary. The font objects automatically cache
 # words to improve lookup speed, we just need to use the same font object each time
 # per font.
 # Keys: (size, weight, style) tuple
-# Values: (tkinter.fonts.Font, tkinter.Label) tuple. For some reason the font object
-#   needs to come with a tkinter label as well to improve performance?
+# Values: (tkinter.fonts.Font, tkinter.Label, word widths) tuple. For some reason the
+#   font object needs to come with a tkinter label as well to improve performance?
 #   yeah, the authors of the browser book dont really know why this is either.
+#   Every font.measure/font.metrics call is a round trip into Tcl, so we also
+#   remember the width of every word measured with this font, and store the width of
+#   a space and the ascent and descent as attributes on the font object.
 FONT_CACHE = {}
 
 
-def get_font(size, weight, style):
-    """Lookup font in the global FONT_CACHE, adding it if it does not exist."""
+def get_font_info(size, weight, style):
+    """Lookup the FONT_CACHE entry for a font, adding it if it does not exist.
+
+    Returns: tuple
+        (font, label, dict of word -> width)
+
+    """
     key = (size, weight, style)
     if key not in FONT_CACHE:
         font = tkinter.font.Font(size=size, weight=weight, slant=style)
         label = tkinter.Label(font=font)
-        FONT_CACHE[key] = (font, label)
-    return FONT_CACHE[key][0]
+        font.space_width = font.measure(" ")
+        metrics = font.metrics()
+        font.ascent = metrics["ascent"]
+        font.descent = metrics["descent"]
+        FONT_CACHE[key] = (font, label, {})
+    return FONT_CACHE[key]
+
+
+def get_font(size, weight, style):
+    """Lookup font in the global FONT_CACHE, adding it if it does not exist."""
+    return get_font_info(size, weight, style)[0]
 
 
 class Text:
     """Text from a leaf of the DOM tree."""
 
+    # There is one node per run of text, so avoid a __dict__ on each of them.
+    __slots__ = ("text", "words", "parent")
+
+    # Text nodes are leaves so never have children, but this field is here for
+    # consistency. It is shared by every node rather than a new list per node.
+    children = ()
+
     def __init__(self, text: str, parent):
         self.text = text
-        self.children = []  # Text nodes are leaves so never have children, but this
-        # field is here for consistency
+        # The interned words of self.text, filled in the first time it is laid out.
+        self.words = None
         self.parent = parent
 
     def __repr__(self):
@@ -44,6 +77,9 @@ class Text:
 class Element:
     """HTML node from the DOM with an opening and closing tag."""
 
+    # There is one node per tag, so avoid a __dict__ on each of them.
+    __slots__ = ("tag", "children", "parent", "attributes")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.children = []
@@ -55,31 +91,62 @@ class Element:
 
 
 def print_tree(node: Text | Element, indent=0):
-    """Pretty print the HTML tree, given the root node."""
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    """Pretty print the HTML tree, given the root node.
+
+    Uses an explicit stack rather than recursion, so deep trees don't hit the
+    recursion limit.
+    """
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print(" " * indent, node)
+        stack.extend((child, indent + 2) for child in reversed(node.children))
 
 
 class HTMLParser:
     """Parser for web HTML text which builds a tree of nodes."""
 
-    SELF_CLOSING_TAGS = [
-        "area",
-        "base",
-        "br",
-        "col",
-        "embed",
-        "hr",
-        "img",
-        "input",
-        "link",
-        "meta",
-        "param",
-        "source",
-        "track",
-        "wbr",
-    ]
+    SELF_CLOSING_TAGS = frozenset(
+        {
+            "area",
+            "base",
+            "br",
+            "col",
+            "embed",
+            "hr",
+            "img",
+            "input",
+            "link",
+            "meta",
+            "param",
+            "source",
+            "track",
+            "wbr",
+        }
+    )
+
+    # One match per token: a whole script or style element, a closing tag, an opening
+    # tag, a run of text, a "<" which runs into another "<" before any ">" (its
+    # contents are text, as a new tag starts at every "<"), or (with no named group) a
+    # comment, a !doctype style declaration or an unterminated tag running to the end
+    # of the body. Comments end at "-->", so a ">" inside one doesn't end it early.
+    # Script and style contents are raw text up to their matching closing tag, so
+    # code like "i < n" inside them can't start a tag. An unterminated comment, script
+    # or style runs to the end of the body, so a missing end is found in one scan
+    # rather than rescanning the rest of the body from every later "<".
+    TOKEN_RE = re.compile(
+        r"<!--.*?(?:-->|\Z)|<![^<>]*>"
+        r"|(?P<raw>(?i:<(?P<raw_open>(?P<raw_name>script|style)\b[^<>]*)>"
+        r"(?P<raw_text>.*?)(?:</(?P=raw_name)\s*>|\Z)))"
+        r"|(?P<close></[^<>]*>)|<(?P<tag>[^<>]*)>|(?P<text>[^<]+)"
+        r"|<(?P<stray>[^<>]*)(?=<)|<[^<>]*",
+        re.S,
+    )
+    # The tag name and the rest of the text inside a tag.
+    TAG_NAME_RE = re.compile(r"\s*(\S+)(.*)", re.S)
+    # One match per attribute: the name, then the value if there is one, either
+    # double quoted, single quoted or bare.
+    ATTRIBUTE_RE = re.compile(r"""([^\s=]+)(?:=(?:"([^"]*)"|'([^']*)'|(\S+)))?""")
 
     def __init__(self, body: str):
         self.body = body
@@ -87,32 +154,41 @@ class HTMLParser:
 
     def parse(self):
         """Parse HTML into tags and text."""
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
-                if text:
+        # Let the regex engine split the body into tokens in C, rather than scanning
+        # for "<" and ">" in a Python loop. Strings are only sliced out of the body
+        # for the groups we read.
+        for match in self.TOKEN_RE.finditer(self.body):
+            kind = match.lastgroup
+            if kind == "text" or kind == "stray":
+                text = match.group(kind)
+                # Skip whitespace between tags here rather than in add_text, which
+                # saves a method call for each gap in pretty-printed HTML.
+                # NOTE: This also handles the edge case where we get /n before opening
+                # any tags.
+                if text and not text.isspace():
                     self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
-            else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
+            elif kind == "tag":
+                self.add_tag(match.group("tag"))
+            elif kind == "close":
+                # Closing tags never look at their name, so skip slicing it out.
+                self.add_closing_tag()
+            elif kind == "raw":
+                self.add_tag(match.group("raw_open"))
+                text = match.group("raw_text")
+                if text and not text.isspace():
+                    self.add_text(text)
+                self.add_closing_tag()
+            # Otherwise it is a comment, a declaration or an unterminated tag at the
+            # end of the body, so drop it.
 
         # Here we are done with parsing the text
         return self.finish()
 
     def add_text(self, text):
-        """Add the given text to the DOM tree as a text node."""
-        if text.isspace():
-            # NOTE: Handle edge case where we get /n before opening any tags.
-            return
+        """Add the given text to the DOM tree as a text node.
 
+        Whitespace-only text is skipped by parse before it gets here.
+        """
         parent = self.unfinished_tags[-1]
         node = Text(text, parent)
         parent.children.append(node)
@@ -120,52 +196,61 @@ class HTMLParser:
     def get_attributes(self, text):
         """Get the attributes of a HTML tag.
 
-        Assumes the ttributes contain no whitespace.
+        Attribute values may be quoted with single or double quotes, in which case
+        they can contain whitespace.
         """
-        parts = text.split()
-        tag = parts[0].casefold()  # Safer way to handle case insensitive stuff.
+        tag, rest = self.TAG_NAME_RE.match(text).groups()
+        # Tag and attribute names are ASCII, so lower() is enough here and is faster
+        # than casefold(), which goes through the full Unicode tables. Interning the
+        # tag name lets later comparisons and dict lookups against the tag name
+        # constants short-circuit on identity.
+        tag = sys.intern(tag.lower())
         attributes = {}
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                # The value might be quoted so we need to remove quotes.
-                if len(value) > 2 and value[0] in ["'", '"']:
-                    value = value[1:-1]
-                attributes[key.casefold()] = value
-            else:
-                attributes[attrpair.casefold()] = ""
+        # findall gives "" for the value groups which didn't match, so at most one of
+        # them is non-empty.
+        for key, double_quoted, single_quoted, bare in self.ATTRIBUTE_RE.findall(rest):
+            attributes[key.lower()] = double_quoted or single_quoted or bare
 
         return tag, attributes
 
     def add_tag(self, tag):
         """Add the given tag to the DOM tree as an element."""
+        if not tag or tag.isspace():
+            # Ignore empty tags like "<>", which have no tag name.
+            return
+        if tag.lstrip().startswith("!"):
+            # Ignore !doctype tags and comments, before parsing any attributes. parse
+            # already drops these, so this is a fast path for direct callers.
+            return
+
         # Separate into tag and attributes
         tag, attributes = self.get_attributes(tag)
 
-        if tag.startswith("!"):
-            # Ignore !doctype tag
+        if tag[0] == "/":
+            self.add_closing_tag()
             return
-        if tag.startswith("/") and len(self.unfinished_tags) == 1:
-            # NOTE: Handle edge case where we are last closing tag with no
-            # unfinished parent.
-            return
-        elif tag.startswith("/"):
-            # This is a closing tag. Finish the last unfinished node in the tree.
-            # NOTE: This assumes no unfinished nodes within the element.
-            node = self.unfinished_tags.pop()
-            parent = self.unfinished_tags[-1]
-            parent.children.append(node)
-        elif tag in self.SELF_CLOSING_TAGS:
+
+        unfinished_tags = self.unfinished_tags
+        # NOTE: Handle edge case if the node is the first it has no parent.
+        parent = unfinished_tags[-1] if unfinished_tags else None
+        node = Element(tag, attributes, parent)
+        if tag in self.SELF_CLOSING_TAGS:
             # Add these tags to the tree without a closing tag.
-            parent = self.unfinished_tags[-1]
-            node = Element(tag, attributes, parent)
             parent.children.append(node)
         else:
             # This is an opening tag - add an unfinished node to the tree.
-            # NOTE: Handle edge case if the node is the first it has no parent.
-            parent = self.unfinished_tags[-1] if self.unfinished_tags else None
-            node = Element(tag, attributes, parent)
-            self.unfinished_tags.append(node)
+            unfinished_tags.append(node)
+
+    def add_closing_tag(self):
+        """Finish the last unfinished node in the tree for a closing tag."""
+        unfinished_tags = self.unfinished_tags
+        if len(unfinished_tags) == 1:
+            # NOTE: Handle edge case where we are last closing tag with no
+            # unfinished parent.
+            return
+        # NOTE: This assumes no unfinished nodes within the element.
+        node = unfinished_tags.pop()
+        unfinished_tags[-1].children.append(node)
 
     def finish(self):
         """Complete the tree by finishing any unfinished nodes."""
@@ -180,9 +265,41 @@ class HTMLParser:
 class Layout:
     """Layout of a webpage."""
 
-    def __init__(self, tokens: list[Element | Text]) -> None:
-        """Initialise a Layout."""
-        self.display_list = []
+    # Font changes made by opening and closing tags, looked up by tag name.
+    # Values: (attribute, value) tuple, where "size" values are added to the current
+    #   size rather than replacing it.
+    OPEN_TAG_STYLES = {
+        "i": ("style", "italic"),
+        "b": ("weight", "bold"),
+        "small": ("size", -2),
+        "big": ("size", 4),
+    }
+    CLOSE_TAG_STYLES = {
+        "i": ("style", "roman"),
+        "b": ("weight", "normal"),
+        "small": ("size", 2),
+        "big": ("size", -4),
+    }
+
+    # Elements whose contents are never displayed, so their subtrees are skipped. This
+    # is safe because HTMLParser reads script and style contents as raw text up to
+    # their closing tag: a "<" in the code can't open a stray element that swallows
+    # the rest of the page into the skipped subtree. The head is not skipped: its
+    # closing tag is optional and the parser doesn't imply it, so on many pages the
+    # body ends up inside the head.
+    SKIP_TAGS = frozenset({"script", "style", "noscript", "template"})
+
+    def __init__(self, tree: Element | Text) -> None:
+        """Initialise a Layout of the DOM tree with the given root node."""
+        # The display list is stored as parallel lists, one entry per word, rather
+        # than as a list of (x, y, word, font) tuples. The x coordinates are packed
+        # into an array of machine ints, 4 bytes each rather than a boxed int per word.
+        # The ys stay a list: the browser bisects them, and bisect indexing an array
+        # would box a new float on every probe.
+        self.xs = array.array("i")
+        self.ys = []
+        self.words = []
+        self.fonts = []
         self.cursor_x = HSTEP
         self.cursor_y = VSTEP
         self.weight = "normal"
@@ -193,49 +310,89 @@ class Layout:
         # pass. This lets us adjust for different font sizes on the same line.
         self.line = []
 
-        for token in tokens:
-            self.layout_token(token)
+        self.recurse_layout(tree)
 
         self.flush()
 
-    def layout_token(
-        self, token: Element | Text
-    ) -> tuple[int | str | tkinter.font.Font]:
-        """Place token in correct place in the layout."""
-        if isinstance(token, Text):
-            for word in token.text.split():
-                # Update font based on html tag parsing variables
-                font = get_font(self.size, self.weight, self.style)
-
-                w = font.measure(word)
-                # Wrap if needed
-                if self.cursor_x + w > WIDTH - HSTEP:
-                    self.flush()
-                    # self.cursor_y += font.metrics("linespace") * 1.25
-                    # self.cursor_x = HSTEP
-
-                self.line.append((self.cursor_x, word, font))
-                self.cursor_x += w + font.measure(" ")
-
-        elif token.tag == "i":
-            self.style = "italic"
-        elif token.tag == "/i":
-            self.style = "roman"
-        elif token.tag == "b":
-            self.weight = "bold"
-        elif token.tag == "/b":
-            self.weight = "normal"
-        elif token.tag == "small":
-            self.size -= 2
-        elif token.tag == "/small":
-            self.size += 2
-        elif token.tag == "big":
-            self.size += 4
-        elif token.tag == "/big":
-            self.size -= 4
-        elif token.tag == "br":  # HTML tag for line break
+    def recurse_layout(self, tree: Element | Text) -> None:
+        """Place every node of the tree in the layout, in document order.
+
+        The tree is walked with an explicit stack rather than recursion, so deeply
+        nested pages don't hit the recursion limit. Each element goes on the stack
+        twice: once to open it and push its children, once to close it.
+        """
+        stack = [(tree, False)]
+        while stack:
+            node, closing = stack.pop()
+            if isinstance(node, Text):
+                self.layout_text(node)
+            elif closing:
+                self.close_tag(node.tag)
+            elif node.tag in self.SKIP_TAGS:
+                # Don't descend into elements which are never displayed.
+                continue
+            else:
+                self.open_tag(node.tag)
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+
+    def layout_text(self, node: Text) -> None:
+        """Place the words of a Text node in the layout, wrapping lines as needed."""
+        # Keep the cursor and loop invariants in locals for the word loop, only syncing
+        # self.cursor_x around a flush. Tags only change the font between Text nodes,
+        # so it is looked up once per node.
+        font, label, word_widths = get_font_info(self.size, self.weight, self.style)
+        space_width = font.space_width
+        right_edge = WIDTH - HSTEP
+        cursor_x = self.cursor_x
+        line_append = self.line.append
+        words = node.words
+        if words is None:
+            # Intern the words, so every repeat of a word on the page shares one string
+            # in the display list and the width cache lookups match on identity.
+            words = node.words = list(map(sys.intern, node.text.split()))
+        for word in words:
+            w = word_widths.get(word)
+            if w is None:
+                # Call Tcl directly, skipping the Font.measure wrapper.
+                w = int(label.tk.call("font", "measure", font.name, word))
+                if len(word_widths) >= WORD_WIDTH_CACHE_SIZE:
+                    # Bound the memory used across many pages. Starting over is
+                    # cheaper than tracking recency like an LRU cache.
+                    word_widths.clear()
+                word_widths[word] = w
+            # Wrap if needed
+            if cursor_x + w > right_edge:
+                self.cursor_x = cursor_x
+                self.flush()
+                cursor_x = self.cursor_x
+
+            line_append((cursor_x, word, font))
+            cursor_x += w + space_width
+        self.cursor_x = cursor_x
+
+    def open_tag(self, tag: str) -> None:
+        """Update the layout state for an opening tag."""
+        change = self.OPEN_TAG_STYLES.get(tag)
+        if change:
+            attribute, value = change
+            if attribute == "size":
+                self.size += value
+            else:
+                setattr(self, attribute, value)
+        elif tag == "br":  # HTML tag for line break
             self.flush()
-        elif token.tag == "/p":  # HTML tag for end of paragraph
+
+    def close_tag(self, tag: str) -> None:
+        """Update the layout state for a closing tag."""
+        change = self.CLOSE_TAG_STYLES.get(tag)
+        if change:
+            attribute, value = change
+            if attribute == "size":
+                self.size += value
+            else:
+                setattr(self, attribute, value)
+        elif tag == "p":  # End of paragraph
             self.flush()
             self.cursor_y += VSTEP  # Add spacing between paragraphs
 
@@ -244,23 +401,38 @@ class Layout:
         if not self.line:
             return
 
-        # Get the max font ascent on self.line
-        metrics = [font.metrics() for x, word, font in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
+        # Find the max font ascent and descent on self.line in a single pass. They are
+        # cached on the font objects, so no Tcl calls here.
+        line = self.line
+        min_ascent = max_ascent = line[0][2].ascent
+        max_descent = 0
+        for x, word, font in line:
+            if font.ascent > max_ascent:
+                max_ascent = font.ascent
+            elif font.ascent < min_ascent:
+                min_ascent = font.ascent
+            if font.descent > max_descent:
+                max_descent = font.descent
 
         # Move the baseline to make room for the max ascent.
         baseline = self.cursor_y + 1.25 * max_ascent
 
-        for x, word, font in self.line:
-            y = baseline - font.metrics("ascent")
-            self.display_list.append((x, y, word, font))
+        # Emit the line top to bottom (tallest font first) so the display list stays
+        # sorted by y, which lets the browser bisect it for the visible words. Most
+        # lines use a single ascent and are already in order.
+        if min_ascent != max_ascent:
+            line = sorted(line, key=lambda item: item[2].ascent, reverse=True)
+        self.xs.extend([x for x, word, font in line])
+        self.ys.extend([baseline - font.ascent for x, word, font in line])
+        self.words.extend([word for x, word, font in line])
+        self.fonts.extend([font for x, word, font in line])
 
         # Move self.cursor_y down to adjust for the deepest descent
-        max_descent = max([metric["descent"] for metric in metrics])
         self.cursor_y = baseline + 1.25 * max_descent
 
         self.cursor_x = HSTEP
-        self.line = []
+        # Empty the line in place, rather than allocating a new list for every line.
+        self.line.clear()
 
 
 class Browser:
@@ -273,27 +445,98 @@ class Browser:
         self.scroll = 0  # Offset between page coords and screen coords.
         self.canvas.pack()
 
+        # Display list as parallel lists of word positions, words and fonts.
+        self.xs = array.array("i")
+        self.ys = []
+        self.words = []
+        self.fonts = []
+        self.drawn = 0  # Number of display list items drawn on the canvas so far.
+        # (y, canvas item id) of the words currently on the canvas, top first.
+        self.items = collections.deque()
+
         # Scrolling
         self.window.bind("<Down>", self.scrolldown)
 
     def load(self, url: URL):
-        """Make a http reqest and display the content."""
-        # Make http request.
-        body = url.request()
+        """Make a http reqest and display the content.
+
+        The request and HTML parsing run on a worker thread so the window stays
+        responsive while a page loads. Layout measures text with tkinter, which may only
+        be used from the main thread, so the parsed tree is handed back through a queue
+        that the main thread polls.
+        """
+        results = queue.Queue()
+        worker = threading.Thread(
+            target=self.fetch_and_parse, args=(url, results), daemon=True
+        )
+        worker.start()
+        self.window.after(LOAD_POLL_MS, self.poll_load, results)
+
+    @staticmethod
+    def fetch_and_parse(url: URL, results: queue.Queue) -> None:
+        """Download and parse the page, putting the tree (or error) on results.
+
+        Runs on the worker thread, so it must not touch tkinter.
+        """
+        try:
+            # Make http request.
+            body = url.request()
+
+            # Parse the HTML into a tree of nodes
+            results.put(HTMLParser(body).parse())
+        except Exception as error:
+            results.put(error)
+
+    def poll_load(self, results: queue.Queue) -> None:
+        """Display the page once the worker thread has parsed it."""
+        try:
+            tree = results.get_nowait()
+        except queue.Empty:
+            self.window.after(LOAD_POLL_MS, self.poll_load, results)
+            return
 
-        # Convert HTML into plain text
-        tokens = lex(body)
+        if isinstance(tree, Exception):
+            raise tree
 
         # Create a display list of the text
-        self.display_list = Layout(tokens).display_list
+        layout = Layout(tree)
+        self.xs = layout.xs
+        self.ys = layout.ys
+        self.words = layout.words
+        self.fonts = layout.fonts
+        self.drawn = 0
+        self.items.clear()
+        self.canvas.delete("all")
         self.draw()
 
     def draw(self) -> None:
-        """Render text character by character."""
-        for x, y, c, font in self.display_list:
-            if y > self.scroll + HEIGHT or y + VSTEP < self.scroll:
-                continue
-            self.canvas.create_text(x, y - self.scroll, text=c, anchor="nw", font=font)
+        """Update the canvas items for the words which are in view.
+
+        Items stay on the canvas once created and are moved when scrolling, so only
+        words below everything drawn so far need a create_text call. Items which have
+        scrolled off the top are deleted, so the canvas holds about a screenful of
+        items however long the page is. The display list is sorted by y, so the
+        visible words are found by bisection.
+        """
+        items = self.items
+        offscreen = []
+        while items and items[0][0] + VSTEP < self.scroll:
+            offscreen.append(items.popleft()[1])
+        if offscreen:
+            self.canvas.delete(*offscreen)
+
+        start = bisect.bisect_left(self.ys, self.scroll - VSTEP)
+        end = bisect.bisect_right(self.ys, self.scroll + HEIGHT)
+        for i in range(max(start, self.drawn), end):
+            item = self.canvas.create_text(
+                self.xs[i],
+                self.ys[i] - self.scroll,
+                text=self.words[i],
+                anchor="nw",
+                font=self.fonts[i],
+            )
+            items.append((self.ys[i], item))
+        self.drawn = max(self.drawn, end)
 
     def scrolldown(self, e) -> None:
         """Scroll the displayed text down.
@@ -301,13 +544,11 @@ class Browser:
         The argument e is an igored tkinter event.
         """
         self.scroll += SCROLL_STEP
-        self.canvas.delete("all")
+        self.canvas.move("all", 0, -SCROLL_STEP)
         self.draw()
 
 
 if __name__ == "__main__":
-    import sys
-
     browser = Browser()
     url = URL(sys.argv[1])
     body = url.request()
@@ -3,6 +3,13 @@
 import socket
 import ssl
 
+RECV_SIZE = 65536  # Bytes to ask for per socket.recv call.
+
+# Idle keep-alive connections, so repeat requests to a server reuse its socket.
+# Keys: (scheme, host, port) tuple
+# Values: socket.socket (or ssl.SSLSocket for https)
+CONNECTION_POOL = {}
+
 
 class URL:
     """URL object handling parsing and HTTP requests."""
@@ -34,10 +41,26 @@ class URL:
     def request(self):
         """Download the webpage specified by self.
 
+        Reuses an idle keep-alive connection to the same server if there is one.
+
         Returns: str
             web content
 
         """
+        key = (self.scheme, self.host, self.port)
+        pooled_socket = CONNECTION_POOL.pop(key, None)
+        if pooled_socket is not None:
+            try:
+                return self.send_request(pooled_socket)
+            except OSError:
+                # The server has probably closed the idle connection, so retry on a
+                # new one. send_request has already closed the socket.
+                pass
+
+        return self.send_request(self.connect())
+
+    def connect(self):
+        """Open a new socket connection to self.host."""
         # Create socket connection to self.host
         host_connection_socket = socket.socket(
             family=socket.AF_INET,
@@ -53,35 +76,83 @@ class URL:
                 host_connection_socket, server_hostname=self.host
             )
 
-        # Create HTTP request
-        request = f"GET {self.path} HTTP/1.0\nHost: {self.host}\n\n"
-        host_connection_socket.send(request.encode("utf8"))
-
-        # Get response as a string
-        # afaik makefile is just a helper which waits for all bits to arrive from the
-        # socket.
-        response = host_connection_socket.makefile("r", encoding="utf8")
-
-        # Parse the status line in the response
-        statusline = response.readline()
-        version, status, explanation = statusline.split(" ", maxsplit=2)
-
-        # Parse the headers in the response
-        response_headers = {}
-        while True:
-            line = response.readline()
-            if line == "\n":
-                break
-            header, value = line.split(":", maxsplit=1)
-            response_headers[header.lower()] = value.strip()
-
-        # Ensure that some weird encodings are not present? IDK
-        assert (
-            "transfer-encoding" not in response_headers
-            and "content-encoding" not in response_headers
-        )
+        return host_connection_socket
+
+    def send_request(self, host_connection_socket):
+        """Request self.path over the given connection and return the web content.
+
+        The connection is put in CONNECTION_POOL afterwards if the server agreed to
+        keep it alive, otherwise it is closed. It is also closed if anything goes
+        wrong, before the exception is re-raised.
+        """
+        try:
+            # Create HTTP request. Ask the server to keep the connection open, so later
+            # requests to it skip the TCP (and TLS) handshake.
+            request = (
+                f"GET {self.path} HTTP/1.0\r\n"
+                f"Host: {self.host}\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n"
+            )
+            host_connection_socket.sendall(request.encode("utf8"))
+
+            # Read straight from the socket into one buffer until the headers have
+            # arrived, they end at the first blank line. Going through a text makefile()
+            # wrapper would copy the response through extra Python-level buffers.
+            response = bytearray()
+            while (headers_end := response.find(b"\r\n\r\n")) < 0:
+                chunk = host_connection_socket.recv(RECV_SIZE)
+                if not chunk:
+                    raise ConnectionError(
+                        "connection closed before the response headers"
+                    )
+                response += chunk
+            status_and_headers = response[:headers_end].decode("utf8").split("\r\n")
+
+            # Parse the status line in the response
+            statusline = status_and_headers[0]
+            version, status, explanation = statusline.split(" ", maxsplit=2)
+
+            # Parse the headers in the response
+            response_headers = {}
+            for line in status_and_headers[1:]:
+                header, value = line.split(":", maxsplit=1)
+                response_headers[header.lower()] = value.strip()
+
+            # Ensure that some weird encodings are not present? IDK
+            assert (
+                "transfer-encoding" not in response_headers
+                and "content-encoding" not in response_headers
+            )
+
+            # Read the rest of the web content. With a Content-Length we know where it
+            # ends, otherwise the server marks the end by closing the connection.
+            body_start = headers_end + 4
+            content_length = response_headers.get("content-length")
+            if content_length is not None:
+                body_end = body_start + int(content_length)
+                while len(response) < body_end:
+                    chunk = host_connection_socket.recv(RECV_SIZE)
+                    if not chunk:
+                        break
+                    response += chunk
+            else:
+                while chunk := host_connection_socket.recv(RECV_SIZE):
+                    response += chunk
+                body_end = len(response)
+
+            # Decode the web content, viewing the buffer rather than copying it first.
+            content = str(memoryview(response)[body_start:body_end], "utf8")
+        except BaseException:
+            # Don't leak the connection when the response can't be read or parsed.
+            host_connection_socket.close()
+            raise
+
+        keep_alive = response_headers.get("connection", "").lower() == "keep-alive"
+        if content_length is not None and keep_alive and len(response) == body_end:
+            key = (self.scheme, self.host, self.port)
+            CONNECTION_POOL[key] = host_connection_socket
+        else:
+            host_connection_socket.close()
 
-        # Get the web content and close the socket
-        content = response.read()
-        host_connection_socket.close()
         return content